@@ -1,9 +1,20 @@
 
 
 import logging
+from sys import intern
+
+__all__ = ["Message"]
 
 logger = logging.getLogger(__name__)
 
+# Every message carries the same tag keys. Interned keys are shared between all tag dictionaries,
+# and keeping the most common ones referenced here ensures they are not freed and re-created
+# whenever no message with tags happens to be alive.
+_COMMON_TAG_KEYS = tuple(intern(key) for key in (
+    "badge-info", "badges", "bits", "client-nonce", "color", "display-name", "emotes",
+    "first-msg", "flags", "id", "mod", "msg-id", "returning-chatter", "room-id",
+    "subscriber", "tmi-sent-ts", "turbo", "user-id", "user-type"))
+
 
 class Message:
     # How messages are parsed, and what the Message class attributes represent:
@@ -16,12 +27,15 @@ class Message:
     # |                                                                                                                                                                                                                                                                                          |
     # +-------------------------------------------------------------------------------------------------------------------------------------[ FULL_MESSAGE ]-------------------------------------------------------------------------------------------------------------------------------------+
 
-    def __init__(self, raw_data):
-        split = raw_data.split(" :")
+    # A Message only ever holds these attributes, so we avoid giving every instance a __dict__.
+    __slots__ = ("full_message", "_raw_tags", "_tags", "command",
+                 "user", "type", "params", "channel", "message")
 
+    def __init__(self, raw_data):
         # These parameters will be filled based onthe raw_data given
         self.full_message = raw_data
-        self.tags = {}
+        self._raw_tags = None
+        self._tags = None
         self.command = None
         self.user = None
         self.type = None
@@ -30,95 +44,156 @@ class Message:
         self.message = None
 
         try:
-            if split[0][0] == "@":
-                self.parse_tags(split)
+            # The tags, command and message are separated by " :". Rather than splitting
+            # on every " :", which would also split the message itself, we only find the
+            # positions of the separators we need, and slice the data once per part.
+            start = 0
+            if raw_data[0] == "@":
+                # The tags are only parsed once they are used, see `tags`.
+                start = raw_data.find(" :")
+                self._raw_tags = raw_data[1:start]
+                start += 2
+            elif raw_data[0] == ":":
+                # Skip the : that prefixes the command if there are no tags.
+                start = 1
+            elif raw_data.startswith(("PING", "PONG")):
+                # For some reason PING messages have a different format than the rest
+                # of the messages Twitch sends us.
+                # We will handle this message differently for this reason
+                self.parse_ping(raw_data)
+                return
 
-            # Get full command as it is sent to us
-            # We remove the : that may be left over if the
-            # split on " :" didn't remove it.
-            self.command = split.pop(0).replace(":", "")
-
-            # For some reason PING messages have a different format than the rest
-            # of the messages Twitch sends us.
-            # We will handle this message differently for this reason
-            if self.command.startswith(("PING", "PONG")):
-                self.type = self.command[:4]
+            message_index = raw_data.find(" :", start)
+
+            # The vast majority of messages are chat messages, which always have the same format:
+            # :<user>!<user>@<user>.tmi.twitch.tv PRIVMSG #<channel> :<message>
+            # So we can skip the general parsing of the command for these.
+            user_end = raw_data.find(" ", start)
+            if message_index >= 0 and raw_data.startswith("PRIVMSG #", user_end + 1):
+                self.parse_privmsg(raw_data, start, user_end, message_index)
                 return
 
+            # Get full command as it is sent to us
+            if message_index < 0:
+                self.command = raw_data[start:]
+            else:
+                self.command = raw_data[start:message_index]
+
             # Parse command into smaller bits
             # :<user>!<user>@<user>.tmi.twitch.tv <type> <params>, or
             # :<user>.tmi.twitch.tv <type> <params>, or
             # :tmi.twitch.tv <type> <params>, or
             # :jtv MODE #<channel> <params>
 
-            # Note, we chose to send these values as parameters to indicate dependencies
-            self.parse_user(self.command)
-            self.parse_type(self.command)
-            self.parse_params(self.command, self.type)
-            self.parse_channel(self.params)
+            self.parse_command(self.command)
 
-            self.parse_message(split)
+            self.parse_message(
+                raw_data[message_index + 2:] if message_index >= 0 else "")
         except Exception as e:
             logger.error(
-                "The Message state at the time of the Exception:\n" + str(self))
+                "The Message state at the time of the Exception:\n%s", self)
             raise e
 
-    def parse_tags(self, split):
-        # Get data in format @key=data; ... key=data;
-        # and transform to usable dictionary type under self.tags:
-        for fact in split.pop(0)[1:].split(";"):
+    @property
+    def tags(self):
+        # Many messages are handled without ever looking at the tags,
+        # so we only parse them the first time they are requested.
+        if self._tags is None:
+            self._tags = self.parse_tags(self._raw_tags) if self._raw_tags is not None else {}
+        return self._tags
+
+    @tags.setter
+    def tags(self, tags):
+        self._tags = tags
+
+    @staticmethod
+    def parse_tags(raw_tags):
+        # Get data in format key=data; ... key=data;
+        # and transform to usable dictionary type for self.tags:
+        tags = {}
+        for fact in raw_tags.split(";"):
             key, data = fact.split("=", 1)
-            self.tags[key] = data if len(data) > 0 else ""
+            tags[intern(key)] = data
+        return tags
+
+    def parse_ping(self, raw_data):
+        # PING :tmi.twitch.tv
+        # Only the command and type are filled for these messages.
+        message_index = raw_data.find(" :")
+        self.command = raw_data if message_index < 0 else raw_data[:message_index]
+        self.type = raw_data[:4]
+
+    def parse_privmsg(self, raw_data, start, user_end, message_index):
+        # <user>!<user>@<user>.tmi.twitch.tv PRIVMSG #<channel> :<message>
+        # |                                 |       |          |
+        # start                             user_end|          message_index
+        #                                           user_end + 9
+        self.command = raw_data[start:message_index]
+        self.parse_user(self.command, user_end - start)
+        self.type = "PRIVMSG"
+        self.params = raw_data[user_end + 9:message_index]
+        self.channel = raw_data[user_end + 10:message_index]
+        self.parse_message(raw_data[message_index + 2:])
+
+    def parse_command(self, command):
+        # Walk over the command once, and fill the type and params directly
+        # from the positions found, rather than having every part search through the command again.
+        # Note, we chose to send these values as parameters to indicate dependencies
+        user_end = command.find(" ")
+        if user_end < 0:
+            user_end = len(command)
 
-    def parse_user(self, command):
-        # Get data before tmi.twitch.tv, then get data before !
-        # Note that not all commands have a user specified
-        if not command.startswith(("jtv ", "tmi.twitch.tv ")):
-            self.user = command.split("tmi.twitch.tv")[0].split("!")[0]
-
-    def parse_type(self, command):
         # Commands types are the first word after tmi.twitch.tv,
         # with only one exception: CAP * ACK, which consists of multiple words.
-        self.type = command.split(" ")[1]\
-            if "CAP * ACK" not in command else "CAP * ACK"
+        type_start = user_end + 1
+        if command.startswith("CAP * ACK", type_start):
+            type_end = type_start + 9
+        else:
+            type_end = command.find(" ", type_start)
+            if type_end < 0:
+                type_end = len(command)
+        self.type = command[type_start:type_end]
 
-    def parse_params(self, command, message_type):
         # Get all the remaining parameters used in the command.
         # For example the channel you are attempting to join, or the user that is being modded.
-        # We use the index of self.type to get everything listed after the type.
-        params = command[command.index(message_type) + len(message_type) + 1:]
-        self.params = params if len(params) > 0 else ""
+        self.params = command[type_end + 1:]
 
-    def parse_channel(self, params):
-        def get_index(string, substring, start=0):
-            try:
-                return string.index(substring, start)
-            except ValueError:
-                return None
+        self.parse_user(command, user_end)
+        self.parse_channel(self.params)
 
-        # We will look through self.params to find if one of the parameters is a channel.
-        if self.params is not None:
-            chan_index = get_index(params, "#")
-            if chan_index is not None:
-                self.channel = params[chan_index + 1:
-                                      get_index(params, " ", chan_index)]
+    def parse_user(self, command, user_end):
+        # Get data before !, or otherwise the data before .tmi.twitch.tv
+        # Note that not all commands have a user specified
+        # The commands without user start with either j or t, so we can skip
+        # checking the full prefixes for every user starting with another character.
+        if command[:1] not in "jt" or not command.startswith(("jtv ", "tmi.twitch.tv ")):
+            end = command.find("!", 0, user_end)
+            if end < 0:
+                end = command.find(".tmi.twitch.tv", 0, user_end)
+                if end < 0:
+                    end = user_end
+            self.user = command[:end]
 
-    def parse_message(self, split):
+    def parse_channel(self, params):
+        # We will look through self.params to find if one of the parameters is a channel.
+        chan_index = params.find("#")
+        if chan_index >= 0:
+            chan_end = params.find(" ", chan_index)
+            if chan_end < 0:
+                self.channel = params[chan_index + 1:]
+            else:
+                self.channel = params[chan_index + 1:chan_end]
+
+    def parse_message(self, message):
         # Not everything we get sent has a message attached to it. If there is no message, we use ""
-        if len(split) > 0:
-            # If the message itself contains " :",
-            # then `split` will have be a list of multiple items. We will join them again.
-            message = " :".join(split)
-            # If someone used /me, it reaches us as ╔ACTION, e.g.
-            # /me This is a test -> ╔ACTION This is a test╔
-            # In most cases we just want /me however, so I'll replace it.
-            # Note that the first and last character have id 1
-            if ord(message[0]) == 1 and message[1:7] == "ACTION":
-                # Replace ╔ACTION with /me, and remove the last ╔
-                message = "/me" + message[7:-1]
-            self.message = message
-        else:
-            self.message = ""
+        # If someone used /me, it reaches us as ╔ACTION, e.g.
+        # /me This is a test -> ╔ACTION This is a test╔
+        # In most cases we just want /me however, so I'll replace it.
+        # Note that the first and last character have id 1
+        if message.startswith("\x01ACTION"):
+            # Replace ╔ACTION with /me, and remove the last ╔
+            message = "/me" + message[7:-1]
+        self.message = message
 
     def __str__(self):
         return f"""\
@@ -1,14 +1,50 @@
 
+import selectors
 import socket
 import threading
 import time
 import logging
+import queue
 from typing import Callable, List, Optional, Union
 
 from TwitchWebsocket.Message import Message
 
+__all__ = ["TwitchWebsocket"]
+
 logger = logging.getLogger(__name__)
 
+# Encoded IRC commands, so they don't need to be encoded again for every message sent.
+_CRLF = b"\r\n"
+_CMD_JOIN = b"JOIN "
+_CMD_PART = b"PART "
+_CMD_NICK = b"NICK "
+_CMD_PASS = b"PASS "
+_CMD_CAP_REQ = b"CAP REQ :twitch.tv/"
+# PING and PONG never have any content, so these are complete lines.
+_CMD_PING = b"PING \r\n"
+_CMD_PONG = b"PONG \r\n"
+# Complete CAP REQ lines for the capabilities Twitch offers, separately and all at once,
+# keyed by the tuple of lowercase capabilities as passed to `add_capability`.
+_CAP_BYTES = {
+    caps: _CMD_CAP_REQ + " twitch.tv/".join(caps).encode('UTF-8') + _CRLF
+    for caps in (("membership",), ("tags",), ("commands",), ("membership", "tags", "commands"))
+}
+
+
+def _cap_req_line(capability: Union[str, List[str]]) -> Optional[bytes]:
+    """
+    Encoded CAP REQ line requesting all of `capability`, or None if there is nothing to request.
+    """
+    if isinstance(capability, str):
+        capability = [capability]
+    if not capability:
+        return None
+    capability = tuple(cap.lower() for cap in capability)
+    line = _CAP_BYTES.get(capability)
+    if line is None:
+        line = _CMD_CAP_REQ + " twitch.tv/".join(capability).encode('UTF-8') + _CRLF
+    return line
+
 
 class TwitchWebsocket(threading.Thread):
     """
@@ -18,13 +54,14 @@ class TwitchWebsocket(threading.Thread):
 
     def __init__(self,
                  host: str,
-                 port: str,
+                 port: int,
                  chan: str,
                  nick: str,
                  auth: str,
                  callback: Callable[[Message], None],
                  capability: Optional[Union[List[str], str]] = None,
-                 live: bool = True):
+                 live: bool = True,
+                 flush_interval_ms: int = 0):
         """
         `host`: IRC Host, generally "irc.chat.twitch.tv".
         `port`: Socket port, generally `6667`.
@@ -34,10 +71,13 @@ class TwitchWebsocket(threading.Thread):
         `callback`: The function or method that takes a `Message` object as parameter.
         `capability`: List of strings with extra information to be requested from Twitch. See docs.
         `live`: send_message() messages are posted in chat if True, otherwise only in the console.
+        `flush_interval_ms`: If positive, data sent within this many milliseconds is combined
+            and sent at once. PING and PONG are always sent immediately.
         """
         assert isinstance(host, str)
         assert isinstance(port, int)
         assert callable(callback)
+        assert isinstance(flush_interval_ms, int) and flush_interval_ms >= 0
         threading.Thread.__init__(self)
         # Thread parameters
         self.name = "TwitchWebsocket"
@@ -47,13 +87,62 @@ class TwitchWebsocket(threading.Thread):
         # Store passed variables
         self.host = host
         self.port = port
-        self.chan = chan if chan[0] == "#" else "#" + chan
+        self.chan = chan
         self.nick = nick
         self.auth = auth
         self.capability = capability
         self.callback = callback
         self.live = live
+        self.flush_interval_ms = flush_interval_ms
         self.conn = None
+        # Used to wait until either the connection has received data, or `stop()` is called.
+        # `stop()` wakes the selector up by writing to `self._wakeup_writer`.
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_writer.setblocking(False)
+        self._selector.register(self._wakeup_reader, selectors.EVENT_READ)
+        # Received lines are passed from `run()` to `_dispatch()` via this queue. If the callback
+        # can't keep up, `run()` waits until there is room again, rather than storing ever more
+        # data. In the meantime, Twitch holds on to data that hasn't been received yet.
+        self._queue = queue.Queue(maxsize=1024)
+        # Prevents data sent from different threads at the same time from being interleaved,
+        # and from being sent while `self.conn` is being replaced.
+        self._send_lock = threading.Lock()
+        # Whether `connect()` has logged in over `self.conn`. Until then, nothing else is sent.
+        self._logged_in = False
+        # If `flush_interval_ms` is positive, data to send is collected here until `_flush()`
+        # is called by `_flush_timer`, or until enough data has been collected.
+        self._out_buf = bytearray()
+        self._flush_timer = None
+
+    @property
+    def chan(self) -> str:
+        """
+        Twitch channel of the chat that `send_message()` posts in, e.g. "#Tom".
+        """
+        return self._chan
+
+    @chan.setter
+    def chan(self, chan: str) -> None:
+        self._chan = chan if chan.startswith("#") else "#" + chan
+        # Lowercased once here, as this channel is joined again on every reconnect.
+        self._chan_lower = self._chan.lower()
+        # Every message is sent to this channel, so we prepare the encoded
+        # start of the PRIVMSG once, rather than for every message.
+        self._privmsg_prefix = f"PRIVMSG {self._chan_lower} :".encode('UTF-8')
+
+    @property
+    def nick(self) -> str:
+        """
+        Twitch account name used to log in, e.g. "CubieB0T".
+        """
+        return self._nick
+
+    @nick.setter
+    def nick(self, nick: str) -> None:
+        self._nick = nick
+        # Lowercased once here, as we log in with this name again on every reconnect.
+        self._nick_lower = nick.lower()
 
     def start_nonblocking(self):
         """
@@ -87,19 +176,21 @@ class TwitchWebsocket(threading.Thread):
         except (KeyboardInterrupt, SystemExit) as e:
             # Stop the while loop in run()
             self.stop()
-            # Cancel the self.conn.recv() in run()
-            if self.conn is not None:
-                self.conn.shutdown(socket.SHUT_WR)
             # Join this thread
             self.join()
-            logger.info(f"{e.__class__.__name__} detected - shutting down.")
+            logger.info("%s detected - shutting down.", e.__class__.__name__)
 
     def stop(self):
         """
         Set the event that indicates that the bot should stop.
-        The bot will stop receiving messages after the next message.
+        The bot will stop receiving messages immediately, without waiting for the next message.
         """
         self._stop_event.set()
+        try:
+            self._wakeup_writer.send(b"\0")
+        except OSError:
+            # The selector has already been woken up, or `run()` has already finished.
+            pass
 
     def stopped(self) -> bool:
         """
@@ -111,41 +202,119 @@ class TwitchWebsocket(threading.Thread):
     def run(self):
         """
         First connect to Twitch using `connect()`, and then collect messages from Twitch
-        indefinitely. `self.callback` is called with every message received.
-        Automatically reconnects on timeout.
+        indefinitely. `self.callback` is called with every message received, from a separate
+        thread, so a slow callback does not delay receiving data or answering PINGs.
+        Sends a PING if Twitch has not sent anything for 2 minutes, and automatically
+        reconnects if Twitch then doesn't respond within 30 seconds.
         """
+        dispatcher = threading.Thread(target=self._dispatch, name="TwitchWebsocketDispatcher")
+        dispatcher.daemon = True
+        dispatcher.start()
+
         self.connect()
-        # `data` will be continuously appended with received data
-        data = ""
+        # `data` will be continuously appended with received bytes, while `buffer` is
+        # reused for every receive, so no new bytes object is created per packet.
+        data = bytearray()
+        buffer = bytearray(65536)
+        buffer_view = memoryview(buffer)
+        # Whether we sent a PING to check if the connection is still alive, and are
+        # waiting for Twitch to respond.
+        pinged = False
         while not self.stopped():
             try:
-                # Receive data from Twitch Websocket.
-                data += self.conn.recv(8192).decode('UTF-8')
+                # Wait until Twitch Websocket has sent data. `stop()` wakes us up immediately.
+                # Twitch PINGs us roughly every 5 minutes, but a connection can die without
+                # being closed, so we check it ourselves if nothing is received for 2 minutes.
+                ready = self._selector.select(30 if pinged else 120)
+                if self.stopped():
+                    break
+                if not ready:
+                    if pinged:
+                        raise socket.timeout("No response to PING")
+                    self.send_ping()
+                    pinged = True
+                    continue
 
-            except UnicodeDecodeError:
-                # In case of unexpected end of data.
-                logger.warning(
-                    "Received data could not be decoded. Skipping this data.")
-                continue
+                # Receive data from Twitch Websocket.
+                received = self.conn.recv_into(buffer)
+                if received == 0:
+                    raise ConnectionError("Connection closed by Twitch")
+                pinged = False
 
             except OSError as error:
-                logger.error(f"[OSError: {error}] - Attempting to reconnect.")
+                logger.error("[OSError: %s] - Attempting to reconnect.", error)
                 self.connect()
+                # Incomplete data from the previous connection will never be completed.
+                data.clear()
+                pinged = False
                 continue
 
-            data_split = data.split("\r\n")
-            data = data_split.pop()
+            data += buffer_view[:received]
 
-            # Iterate over seperately sent data.
-            for line in data_split:
-                message = Message(line)
+            # Only complete lines are passed on, the remainder is kept in `data`
+            # until the rest of the line has been received.
+            # That remainder has already been searched for b"\r\n", so we only search the
+            # newly received bytes, starting one byte early in case they start with b"\n".
+            end = data.rfind(_CRLF, max(len(data) - received - 1, 0))
+            if end < 0:
+                continue
 
-                # We will do some handling depending on the message ourself,
-                # so the developer doesn't have to.
-                if message.type == "PING":
+            # Decode all complete lines at once, rather than copying and decoding every line
+            # separately. As only complete lines are decoded, characters are never cut in half.
+            # Any invalid bytes are replaced with U+FFFD, rather than losing the entire line.
+            lines = data[:end].decode('UTF-8', 'replace').split("\r\n")
+            del data[:end + 2]
+
+            # We will do some handling depending on the message ourself,
+            # so the developer doesn't have to.
+            for line in lines:
+                if line.startswith("PING"):
                     self.send_pong()
 
-                self.callback(message)
+            self._put(lines, dispatcher)
+
+        # Let the dispatcher finish the lines that were already received.
+        self._put(None, dispatcher)
+        dispatcher.join()
+
+        # Send what is still waiting to be sent, and close the connection,
+        # as nothing will be received anymore.
+        self._flush()
+        self._selector.unregister(self.conn)
+        with self._send_lock:
+            self.conn.close()
+            self._logged_in = False
+        self._selector.close()
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+
+    def _put(self, item: Optional[List[str]], dispatcher: threading.Thread):
+        """
+        Put `item` on the queue for `dispatcher`, waiting while the queue is full.
+        Gives up if `dispatcher` has stopped, as the queue won't be emptied anymore.
+        """
+        while True:
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                if not dispatcher.is_alive():
+                    return
+
+    def _dispatch(self):
+        """
+        Parse the lists of lines received in `run()` into `Message` objects, and call
+        `self.callback` with them, until `run()` passes None to indicate that it has stopped.
+        """
+        try:
+            for lines in iter(self._queue.get, None):
+                for line in lines:
+                    self.callback(Message(line))
+        except BaseException:
+            # Stop receiving messages if the callback fails, just like when the callback
+            # was still called from `run()` directly.
+            self.stop()
+            raise
 
     def _send(self, command: str, message: str):
         """
@@ -153,10 +322,83 @@ class TwitchWebsocket(threading.Thread):
         In most cases, the public `send_...` methods should be used instead of this method,
         e.g. `self.send_message(message)` or `self.send_whisper(message, user)`
         """
-        sent = self.conn.send(
-            bytes("{}{}\r\n".format(command, message), 'UTF-8'))
-        if sent == 0:
-            raise RuntimeError("Socket connection broken, sent is 0")
+        self._send_bytes(f"{command}{message}\r\n".encode('UTF-8'))
+
+    def _send_encoded(self, command: bytes, message: str):
+        """
+        Like `self._send(command, message)`, but with `command` already encoded,
+        so only `message` has to be encoded for every call.
+        """
+        self._send_bytes(command + message.encode('UTF-8') + _CRLF)
+
+    def _send_batch(self, lines: List[bytes]):
+        """
+        Send all encoded `lines` to Twitch at once, rather than with a separate send each.
+        Used by `connect()` to log in, after which other data may be sent as well.
+        """
+        with self._send_lock:
+            self._sendall_locked(b"".join(lines))
+            self._logged_in = True
+
+    def _send_bytes(self, data: bytes, flush: bool = False):
+        """
+        Send the encoded `data` to Twitch. All other sending methods end up here,
+        so that data sent from different threads at the same time is never interleaved.
+        If `flush` is True, `data` and any collected data is sent immediately,
+        even if `flush_interval_ms` is positive.
+        """
+        with self._send_lock:
+            if not self._logged_in:
+                logger.warning("Not logged in to Twitch. Not sending this data.")
+                return
+
+            if not self.flush_interval_ms:
+                self._sendall_locked(data)
+                return
+
+            self._out_buf += data
+            if flush or len(self._out_buf) >= 4096:
+                self._flush_locked()
+            elif self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.flush_interval_ms / 1000, self._flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def _flush(self):
+        """
+        Send all data collected while `flush_interval_ms` is positive to Twitch at once.
+        """
+        with self._send_lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        """
+        Implementation of `_flush()`, for when `self._send_lock` is already held.
+        """
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if self._out_buf:
+            self._sendall_locked(self._out_buf)
+            self._out_buf.clear()
+
+    def _sendall_locked(self, data: bytes):
+        """
+        Send `data` over `self.conn`, for when `self._send_lock` is already held.
+        If sending fails, the connection is shut down, so `run()` will reconnect.
+        Sends may come from the callback or from `_flush_timer`, so the error is
+        logged rather than raised, as it is not caused by the caller.
+        """
+        try:
+            self.conn.sendall(data)
+        except OSError as error:
+            logger.error("[OSError: %s] - Failed to send data. Attempting to reconnect.", error)
+            try:
+                # Makes `run()` receive 0 bytes, after which it reconnects.
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # The connection is already closed.
+                pass
 
     def send_join(self, channel: str) -> None:
         """
@@ -165,7 +407,7 @@ class TwitchWebsocket(threading.Thread):
         `channel` must be a string and nonempty. May be prepended with "#",
         and can have any casing , e.g. "#Tom" is equivalent to "tom".
         """
-        self._send("JOIN ", channel)
+        self._send_encoded(_CMD_JOIN, channel)
 
     def send_part(self, channel: str) -> None:
         """
@@ -174,28 +416,34 @@ class TwitchWebsocket(threading.Thread):
         `channel` must be a string and nonempty. May be prepended with "#",
         and can have any casing , e.g. "#Tom" is equivalent to "tom".
         """
-        self._send("PART ", channel)
+        self._send_encoded(_CMD_PART, channel)
 
     def send_pong(self) -> None:
         """
         Send PONG over IRC to Twitch.
         """
-        self._send("PONG ", "")
+        self._send_bytes(_CMD_PONG, flush=True)
 
     def send_ping(self) -> None:
         """
         Send PING over IRC to Twitch.
         """
-        self._send("PING ", "")
+        self._send_bytes(_CMD_PING, flush=True)
 
     def send_message(self, message: str) -> None:
         """
         Send `message` in the connected Twitch Chat using the connected Twitch account,
         but only if `self.live` is True.
         If this boolean is False, simply print out `message`.
+        Messages longer than 500 characters are dropped by Twitch, so they are not sent.
         """
         if self.live:
-            self._send("PRIVMSG {} :".format(self.chan.lower()), message)
+            if len(message) > 500:
+                logger.warning(
+                    "Message of %d characters exceeds Twitch's limit of 500 characters. "
+                    "Not sending this message.", len(message))
+                return
+            self._send_bytes(self._privmsg_prefix + message.encode('UTF-8') + _CRLF)
         else:
             print(message)
 
@@ -212,14 +460,14 @@ class TwitchWebsocket(threading.Thread):
         Send a NICK message to Twitch to identify the
         bot with the username/nickname `nickname`.
         """
-        self._send("NICK ", nickname)
+        self._send_encoded(_CMD_NICK, nickname)
 
     def send_pass(self, authentication):
         """
         Send a PASS message to Twitch to authenticate the
         bot with the authentication `authentication`.
         """
-        self._send("PASS ", authentication)
+        self._send_encoded(_CMD_PASS, authentication)
 
     def send_req(self, capability: str) -> None:
         """
@@ -227,7 +475,7 @@ class TwitchWebsocket(threading.Thread):
         commands, data, etc. See https://dev.twitch.tv/docs/irc/guide#twitch-irc-capabilities
         for more information.
         """
-        self._send("CAP REQ ", ":twitch.tv/" + capability)
+        self._send_encoded(_CMD_CAP_REQ, capability)
 
     def connect(self):
         """
@@ -236,40 +484,60 @@ class TwitchWebsocket(threading.Thread):
         data from Twitch.
         """
         self._initialize_websocket()
-        self.login(self.nick, self.auth)
-        self.join_channel(self.chan)
+        # The lines for logging in, joining and requesting capabilities are sent all at once.
+        # They are built here rather than with `login()` and the like, so that data sent by
+        # the callback at the same time can't end up in between them.
+        lines = [
+            _CMD_PASS + self.auth.encode('UTF-8') + _CRLF,
+            _CMD_NICK + self._nick_lower.encode('UTF-8') + _CRLF,
+            _CMD_JOIN + self._chan_lower.encode('UTF-8') + _CRLF,
+        ]
         if self.capability is not None:
-            self.add_capability(self.capability)
+            line = _cap_req_line(self.capability)
+            if line is not None:
+                lines.append(line)
+        self._send_batch(lines)
 
     def _initialize_websocket(self):
         """
-        Set up socket connection with Twitch, with a timeout of 330 seconds.
-        After 330 seconds, the bot will timeout and automatically reconnect.
+        Set up socket connection with Twitch, with a timeout of 330 seconds for sending.
+        Whether Twitch is still responding is checked in `run()`.
         """
-        def get_reconnection_delay():
-            """
-            Yield exponential increase, starting with 0, 1, 2, 4, 8, 16, ...
-            and ending at 512, which is repeated infinitely.
-            """
-            yield 0
-            for val in (2**i for i in range(10)):  # Yields 1, 2, ..., 256, 512
-                yield val
-            while True:  # Yields 512, 512, 512, ...
-                yield val
+        # The number of failed attempts to connect so far
+        failed_attempts = 0
 
-        reconnection_delay_gen = get_reconnection_delay()
+        if self.conn is not None:
+            # Stop waiting on and close the previous connection before reconnecting.
+            self._selector.unregister(self.conn)
+            with self._send_lock:
+                self.conn.close()
+                # Nothing is sent until we have logged in again over the new connection.
+                # Data meant for the previous connection is not sent over the new one either.
+                self._logged_in = False
+                self._out_buf.clear()
 
         while True:
             try:
                 logger.info("Attempting to initialize websocket connection.")
-                self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                # We set the timeout to 330 seconds, as the PING from the Twitch server indicating
-                # That the connection is still live is sent roughly every 5 minutes it seems.
-                # the extra 30 seconds prevents us from checking the connection when it's not
-                # needed.
+                # Give up on connecting after 10 seconds, so an unreachable host doesn't hold up
+                # the next attempt for the full timeout. The socket is closed if this fails.
+                self.conn = socket.create_connection((self.host, self.port), timeout=10)
+                # We set the timeout to 330 seconds, so sending data can't block forever.
+                # Receiving is not affected, as `run()` only receives once data is available.
                 self.conn.settimeout(330)
 
-                self.conn.connect((self.host, self.port))
+                try:
+                    # Send small messages such as PONG immediately, rather than waiting to
+                    # combine them with more data, and allow for larger bursts of messages
+                    # to be buffered by the OS.
+                    self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 262144)
+                    self.conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
+                except OSError:
+                    # These options are only an optimization, and might not be supported.
+                    pass
+
+                self._selector.register(self.conn, selectors.EVENT_READ)
                 logger.info("Websocket connection initialized.")
                 # Only return if successful
                 return
@@ -277,9 +545,10 @@ class TwitchWebsocket(threading.Thread):
             except OSError:
                 # Sleep and retry if not successful
                 # reconnect_delay is 0, 1, 2, 4, 8, 16, ..., 512, 512, 512, ...
-                reconnect_delay = next(reconnection_delay_gen)
+                reconnect_delay = min(1 << (failed_attempts - 1), 512) if failed_attempts else 0
+                failed_attempts += 1
                 logger.error(
-                    f"Failed to connect. Sleeping for {reconnect_delay} seconds and retrying...")
+                    "Failed to connect. Sleeping for %s seconds and retrying...", reconnect_delay)
                 time.sleep(reconnect_delay)
 
     def join_channel(self, channel: str) -> None:
@@ -292,7 +561,11 @@ class TwitchWebsocket(threading.Thread):
         """
         assert isinstance(channel, str) and channel
 
-        self.send_join(channel.lower())
+        if channel == self.chan:
+            self.send_join(self._chan_lower)
+        else:
+            channel = channel if channel.startswith("#") else "#" + channel
+            self.send_join(channel.lower())
 
     def leave_channel(self, channel: str) -> None:
         """
@@ -301,7 +574,11 @@ class TwitchWebsocket(threading.Thread):
         `channel` must be a string and nonempty. May be prepended with "#",
         and can have any casing , e.g. "#Tom" is equivalent to "tom".
         """
-        self.send_part(channel.lower())
+        if channel == self.chan:
+            self.send_part(self._chan_lower)
+        else:
+            channel = channel if channel.startswith("#") else "#" + channel
+            self.send_part(channel.lower())
 
     def leave(self) -> None:
         """
@@ -319,7 +596,7 @@ class TwitchWebsocket(threading.Thread):
         assert nickname and authentication
 
         self.send_pass(authentication)
-        self.send_nick(nickname.lower())
+        self.send_nick(self._nick_lower if nickname == self.nick else nickname.lower())
 
     def add_capability(self, capability: Union[str, List[str]]) -> None:
         """
@@ -328,11 +605,11 @@ class TwitchWebsocket(threading.Thread):
         capabilities are "membership", "tags" and "commands".
         See https://dev.twitch.tv/docs/irc/guide#twitch-irc-capabilities for
         more information.
+        All capabilities are requested in one CAP REQ, which Twitch either
+        acknowledges or rejects as a whole.
         """
         assert isinstance(capability, (list, str))
 
-        if isinstance(capability, list):
-            for cap in capability:
-                self.add_capability(cap.lower())
-        else:
-            self.send_req(capability.lower())
+        line = _cap_req_line(capability)
+        if line is not None:
+            self._send_bytes(line)